@@ -21,19 +21,37 @@ const APP_SLUGS = {
   girltalk: ["com.tangentapps.girltalk", "girltalk", "girl_talk"],
 };
 
+// All product_id prefixes compiled once into a single alternation
+const PREFIX_TO_SLUG = new Map();
+for (const [slug, prefixes] of Object.entries(APP_SLUGS)) {
+  for (const p of prefixes) {
+    if (!PREFIX_TO_SLUG.has(p)) PREFIX_TO_SLUG.set(p, slug);
+  }
+}
+const PREFIX_RE = new RegExp(
+  [...PREFIX_TO_SLUG.keys()]
+    .map((p) => p.replace(/[.*+?^${}()|[\]\\]/g, "\\$&"))
+    .join("|")
+);
+
 // Resolve a product_id or app_user_id hint to an app slug
 function resolveApp(productId, appSlugHint) {
   // If the URL path already tells us which app
   if (appSlugHint && APP_SLUGS[appSlugHint]) return appSlugHint;
 
   // Try matching by product_id prefix
-  const pid = (productId || "").toLowerCase();
-  for (const [slug, prefixes] of Object.entries(APP_SLUGS)) {
-    if (prefixes.some((p) => pid.includes(p))) return slug;
-  }
-  return null;
+  const match = PREFIX_RE.exec((productId || "").toLowerCase());
+  return match ? PREFIX_TO_SLUG.get(match[0]) : null;
 }
 
+// Cohort counter field for each classification
+const STATUS_FIELDS = {
+  "Still in Trial": "in_trial",
+  Converted: "converted",
+  Cancelled: "cancelled",
+  "Billing Issue": "billing_issue",
+};
+
 // ─── Classification (mirrors dashboard logic) ───
 // Determine the user's trial exit status from the event type
 function classifyFromEvent(eventType, cancelReason, periodType) {
@@ -170,23 +188,27 @@ exports.cleanup = onRequest(
         return res.status(400).json({ status: "error", reason: "invalid or missing slug" });
       }
 
-      // Delete all docs in subcollections
+      // Delete all docs in subcollections (independent, so drain them in parallel)
       const collections = ["users", "cohorts"];
-      let totalDeleted = 0;
-
-      for (const col of collections) {
-        const colRef = db.collection(`apps/${slug}/${col}`);
-        let snapshot = await colRef.limit(450).get();
-
-        while (!snapshot.empty) {
-          const batch = db.batch();
-          snapshot.docs.forEach((doc) => batch.delete(doc.ref));
-          await batch.commit();
-          totalDeleted += snapshot.size;
-          console.log(`Deleted ${snapshot.size} docs from apps/${slug}/${col}`);
-          snapshot = await colRef.limit(450).get();
-        }
-      }
+      const deletedCounts = await Promise.all(
+        collections.map(async (col) => {
+          // Only refs are needed to delete, so skip fetching document fields
+          const query = db.collection(`apps/${slug}/${col}`).select().limit(450);
+          let deleted = 0;
+          let snapshot = await query.get();
+
+          while (!snapshot.empty) {
+            const batch = db.batch();
+            snapshot.docs.forEach((doc) => batch.delete(doc.ref));
+            await batch.commit();
+            deleted += snapshot.size;
+            console.log(`Deleted ${snapshot.size} docs from apps/${slug}/${col}`);
+            snapshot = await query.get();
+          }
+          return deleted;
+        })
+      );
+      const totalDeleted = deletedCounts.reduce((sum, n) => sum + n, 0);
 
       console.log(`Cleanup complete for ${slug}: ${totalDeleted} docs deleted`);
       return res.status(200).json({ status: "ok", slug, deleted: totalDeleted });
@@ -266,70 +288,68 @@ exports.webhook = onRequest(
       // Determine trial start date for cohort bucketing
       const trialDate = msToDateKey(purchasedAtMs);
 
-      // ─── Update user doc ───
+      // ─── Update user + daily cohort docs atomically ───
+      // Reading the previous status inside the transaction keeps concurrent
+      // events for the same user from double-counting a cohort bucket
       const userRef = db.doc(`apps/${appSlug}/users/${appUserId}`);
-      const userSnap = await userRef.get();
-      const prevStatus = userSnap.exists ? userSnap.data().status : null;
-      const trialStartDate = userSnap.exists
-        ? userSnap.data().trial_start_date || trialDate
-        : trialDate;
-
-      await userRef.set(
-        {
-          status,
-          product: productId,
-          trial_start_date: trialStartDate,
-          last_event: eventType,
-          updated_at: FieldValue.serverTimestamp(),
-        },
-        { merge: true }
-      );
 
-      // ─── Update daily cohort doc ───
-      if (trialStartDate) {
-        const cohortRef = db.doc(
-          `apps/${appSlug}/cohorts/${trialStartDate}`
+      await db.runTransaction(async (tx) => {
+        const userSnap = await tx.get(userRef);
+        const prevStatus = userSnap.exists ? userSnap.data().status : null;
+        const trialStartDate = userSnap.exists
+          ? userSnap.data().trial_start_date || trialDate
+          : trialDate;
+
+        const cohortRef = trialStartDate
+          ? db.doc(`apps/${appSlug}/cohorts/${trialStartDate}`)
+          : null;
+        const cohortSnap = cohortRef ? await tx.get(cohortRef) : null;
+
+        tx.set(
+          userRef,
+          {
+            status,
+            product: productId,
+            trial_start_date: trialStartDate,
+            last_event: eventType,
+            updated_at: FieldValue.serverTimestamp(),
+          },
+          { merge: true }
         );
 
-        await db.runTransaction(async (tx) => {
-          const cohortSnap = await tx.get(cohortRef);
-          const data = cohortSnap.exists
-            ? cohortSnap.data()
-            : {
-                period: trialStartDate,
-                total_trials: 0,
-                in_trial: 0,
-                converted: 0,
-                cancelled: 0,
-                billing_issue: 0,
-              };
-
-          // If this is a brand new user we haven't seen before, increment total
-          if (!prevStatus) {
-            data.total_trials += 1;
-          }
+        if (!cohortRef) return;
+
+        const data = cohortSnap.exists
+          ? cohortSnap.data()
+          : {
+              period: trialStartDate,
+              total_trials: 0,
+              in_trial: 0,
+              converted: 0,
+              cancelled: 0,
+              billing_issue: 0,
+            };
+
+        // If this is a brand new user we haven't seen before, increment total
+        if (!prevStatus) {
+          data.total_trials += 1;
+        }
 
-          // Decrement previous status bucket
-          if (prevStatus === "Still in Trial") data.in_trial = Math.max(0, data.in_trial - 1);
-          else if (prevStatus === "Converted") data.converted = Math.max(0, data.converted - 1);
-          else if (prevStatus === "Cancelled") data.cancelled = Math.max(0, data.cancelled - 1);
-          else if (prevStatus === "Billing Issue") data.billing_issue = Math.max(0, data.billing_issue - 1);
-
-          // Increment new status bucket
-          if (status === "Still in Trial") data.in_trial += 1;
-          else if (status === "Converted") data.converted += 1;
-          else if (status === "Cancelled") data.cancelled += 1;
-          else if (status === "Billing Issue") data.billing_issue += 1;
-
-          // Compute rates
-          const t = data.total_trials || 1;
-          data.conversion_rate = Math.round((data.converted / t) * 10000) / 10000;
-          data.cancel_rate = Math.round((data.cancelled / t) * 10000) / 10000;
-          data.billing_rate = Math.round((data.billing_issue / t) * 10000) / 10000;
-
-          tx.set(cohortRef, data);
-        });
-      }
+        // Decrement previous status bucket
+        const prevField = STATUS_FIELDS[prevStatus];
+        if (prevField) data[prevField] = Math.max(0, data[prevField] - 1);
+
+        // Increment new status bucket
+        data[STATUS_FIELDS[status]] += 1;
+
+        // Compute rates
+        const t = data.total_trials || 1;
+        data.conversion_rate = Math.round((data.converted / t) * 10000) / 10000;
+        data.cancel_rate = Math.round((data.cancelled / t) * 10000) / 10000;
+        data.billing_rate = Math.round((data.billing_issue / t) * 10000) / 10000;
+
+        tx.set(cohortRef, data);
+      });
 
       console.log(
         `Processed ${eventType} for ${appUserId} → ${status} (${appSlug})`